@@ -1,62 +1,237 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import or_
-from app import models, schemas
+from sqlalchemy import or_, func, insert
+from app import models, schemas, sharding
+from app.database import ShardedSession
 from fastapi import HTTPException
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _session_for_id(db: Session, employee_id: int):
+    """Pick the session that holds this employee"""
+    if isinstance(db, ShardedSession):
+        return db.shard(sharding.shard_for_id(employee_id, len(db)))
+    return db
+
+def _query_all(db: Session, build, skip: int = 0, limit: int = None):
+    """Run a query ordered by id on one DB or across all shards, then apply the page"""
+    if isinstance(db, ShardedSession):
+        # Every shard returns its first skip + limit rows; merging those by id gives the global page
+        def run(session):
+            query = build(session).order_by(models.Employee.id)
+            if limit is not None:
+                query = query.limit(max(skip, 0) + max(limit, 0))
+            return query.all()
+        return sharding.merge_by_id(sharding.fan_out(db, run), skip=skip, limit=limit)
+
+    query = build(db).order_by(models.Employee.id).offset(skip)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+def _claim_columns(session: Session):
+    # Plain rows rather than ORM objects, so a stale claim can be deleted and re-added in one session
+    return session.query(
+        models.EmployeeEmail.email, models.EmployeeEmail.employee_id, models.EmployeeEmail.claimed_at
+    )
+
+def _claim_is_live(db: Session, claim):
+    """A claim is live while its employee still uses the email, or while it is too recent to judge"""
+    if sharding.claim_is_recent(claim.claimed_at):
+        return True
+    owner = _session_for_id(db, claim.employee_id)
+    email = owner.query(models.Employee.email).filter(models.Employee.id == claim.employee_id).scalar()
+    return email == claim.email
+
+def _drop_claim(session: Session, email: str, employee_id: int):
+    session.query(models.EmployeeEmail).filter(
+        models.EmployeeEmail.email == email, models.EmployeeEmail.employee_id == employee_id
+    ).delete(synchronize_session=False)
+
+def _email_taken(db: Session, email: str):
+    if isinstance(db, ShardedSession):
+        session = db.shard(sharding.shard_for_email(email, len(db)))
+        claim = _claim_columns(session).filter(models.EmployeeEmail.email == email).first()
+        if claim is None:
+            return False
+        if _claim_is_live(db, claim):
+            return True
+        # Left behind by a release that never ran; the caller's commit takes it over
+        _drop_claim(session, claim.email, claim.employee_id)
+        return False
+    return db.query(models.Employee).filter(models.Employee.email == email).first() is not None
+
+def _claim_email(db: Session, email: str, employee_id: int):
+    """Record a new email in the sharded email directory"""
+    if isinstance(db, ShardedSession):
+        session = db.shard(sharding.shard_for_email(email, len(db)))
+        session.add(models.EmployeeEmail(email=email, employee_id=employee_id))
+        session.commit()
+
+def _release_email(db: Session, email: str, employee_id: int):
+    if isinstance(db, ShardedSession):
+        session = db.shard(sharding.shard_for_email(email, len(db)))
+        try:
+            _drop_claim(session, email, employee_id)
+            session.commit()
+        except Exception:
+            # The entry is now stale, and _email_taken lets the next caller take it over
+            session.rollback()
+            logger.exception("Could not release email claim for employee %s", employee_id)
 
 def create_employee(db: Session, employee: schemas.EmployeeCreate):
     # Check if email exists
-    existing_employee = db.query(models.Employee).filter(models.Employee.email == employee.email).first()
-    if existing_employee:
+    if _email_taken(db, employee.email):
         raise HTTPException(status_code=400, detail="Email already registered")
-    
+
     # Create new employee
-    db_employee = models.Employee(**employee.model_dump())
-    db.add(db_employee)
-    db.commit()
-    db.refresh(db_employee)
+    if isinstance(db, ShardedSession):
+        # Place the row on its email's shard so it commits together with the email entry
+        shard = sharding.shard_for_email(employee.email, len(db))
+        session = db.shard(shard)
+        employee_id = sharding.allocate_ids(session, shard, len(db), 1)[0]
+        db_employee = models.Employee(id=employee_id, **employee.model_dump())
+        session.add(models.EmployeeEmail(email=employee.email, employee_id=employee_id))
+    else:
+        session = db
+        db_employee = models.Employee(**employee.model_dump())
+    session.add(db_employee)
+    session.commit()
+    session.refresh(db_employee)
     return db_employee
 
+def create_employees_bulk(db: Session, rows):
+    """Add validated (row index, data) pairs.
+
+    Without sharding nothing is committed, so the caller can commit the rows
+    together with its own changes. With sharding each shard's rows commit as
+    soon as they are inserted, in shard order, so concurrent callers never
+    hold one shard's ID counter while waiting for another's.
+
+    Returns the number of rows added and an error for every row whose email is taken.
+    """
+    sharded = isinstance(db, ShardedSession)
+    groups = {}
+    for index, data in rows:
+        shard = sharding.shard_for_email(data["email"], len(db)) if sharded else None
+        groups.setdefault(shard, []).append((index, data))
+
+    created = 0
+    errors = []
+    for shard, group in sorted(groups.items()):
+        emails = [data["email"] for _, data in group]
+        if sharded:
+            session = db.shard(shard)
+            taken = set()
+            for claim in _claim_columns(session).filter(models.EmployeeEmail.email.in_(emails)):
+                if _claim_is_live(db, claim):
+                    taken.add(claim.email)
+                else:
+                    _drop_claim(session, claim.email, claim.employee_id)
+        else:
+            session = db
+            taken = {
+                email for (email,) in
+                session.query(models.Employee.email).filter(models.Employee.email.in_(emails))
+            }
+
+        new_rows = []
+        for index, data in group:
+            if data["email"] in taken:
+                errors.append({"row": index, "error": "email: Email already registered"})
+                continue
+            taken.add(data["email"])
+            new_rows.append(data)
+
+        if new_rows and sharded:
+            ids = sharding.allocate_ids(session, shard, len(db), len(new_rows))
+            new_rows = [dict(data, id=employee_id) for data, employee_id in zip(new_rows, ids)]
+            session.execute(
+                insert(models.EmployeeEmail),
+                [{"email": data["email"], "employee_id": data["id"]} for data in new_rows]
+            )
+        if new_rows:
+            session.execute(insert(models.Employee), new_rows)
+            created += len(new_rows)
+        if sharded:
+            session.commit()
+    return created, errors
+
 def get_employee(db: Session, employee_id: int):
-    employee = db.query(models.Employee).filter(models.Employee.id == employee_id).first()
+    session = _session_for_id(db, employee_id)
+    employee = session.query(models.Employee).filter(models.Employee.id == employee_id).first()
     if not employee:
         raise HTTPException(status_code=404, detail="Employee not found")
     return employee
 
 def get_employees(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Employee).offset(skip).limit(limit).all()
+    return _query_all(db, lambda session: session.query(models.Employee), skip=skip, limit=limit)
+
+def get_employee_rows(db: Session, columns, after_id: int = 0, limit: int = 1000, department: str = None):
+    """Get plain column rows with id above after_id, for keyset-paged exports"""
+    def build(session):
+        query = session.query(*columns).filter(models.Employee.id > after_id)
+        if department is not None:
+            query = query.filter(models.Employee.department == department)
+        return query
+    return _query_all(db, build, limit=limit)
+
+def count_employees(db: Session, department: str = None):
+    def count(session):
+        query = session.query(func.count(models.Employee.id))
+        if department is not None:
+            query = query.filter(models.Employee.department == department)
+        return query.scalar()
+    if isinstance(db, ShardedSession):
+        return sum(sharding.fan_out(db, count))
+    return count(db)
 
 def update_employee(db: Session, employee_id: int, employee: schemas.EmployeeUpdate):
-    db_employee = db.query(models.Employee).filter(models.Employee.id == employee_id).first()
+    session = _session_for_id(db, employee_id)
+    db_employee = session.query(models.Employee).filter(models.Employee.id == employee_id).first()
     if not db_employee:
         raise HTTPException(status_code=404, detail="Employee not found")
-    
+
     update_data = employee.model_dump(exclude_unset=True)
-    
+    old_email = db_employee.email
+    email_changed = "email" in update_data and update_data["email"] != old_email
+
     # Check email uniqueness if being updated
-    if "email" in update_data and update_data["email"] != db_employee.email:
-        existing = db.query(models.Employee).filter(models.Employee.email == update_data["email"]).first()
-        if existing:
+    if email_changed:
+        if _email_taken(db, update_data["email"]):
             raise HTTPException(status_code=400, detail="Email already registered")
-    
+        _claim_email(db, update_data["email"], employee_id)
+
     for key, value in update_data.items():
         setattr(db_employee, key, value)
-    
-    db.commit()
-    db.refresh(db_employee)
+
+    try:
+        session.commit()
+    except Exception:
+        session.rollback()
+        if email_changed:
+            _release_email(db, update_data["email"], employee_id)
+        raise
+    if email_changed:
+        _release_email(db, old_email, employee_id)
+    session.refresh(db_employee)
     return db_employee
 
 def delete_employee(db: Session, employee_id: int):
-    db_employee = db.query(models.Employee).filter(models.Employee.id == employee_id).first()
+    session = _session_for_id(db, employee_id)
+    db_employee = session.query(models.Employee).filter(models.Employee.id == employee_id).first()
     if not db_employee:
         raise HTTPException(status_code=404, detail="Employee not found")
-    
-    db.delete(db_employee)
-    db.commit()
+
+    email = db_employee.email
+    session.delete(db_employee)
+    session.commit()
+    _release_email(db, email, employee_id)
     return {"success": True, "message": "Employee deleted successfully"}
 
-def search_employees(db: Session, keyword: str):
+def search_employees(db: Session, keyword: str, skip: int = 0, limit: int = None):
     """Search employees by keyword in name, email, department, or position"""
-    return db.query(models.Employee).filter(
+    return _query_all(db, lambda session: session.query(models.Employee).filter(
         or_(
             models.Employee.first_name.ilike(f"%{keyword}%"),
             models.Employee.last_name.ilike(f"%{keyword}%"),
@@ -64,12 +239,15 @@ def search_employees(db: Session, keyword: str):
             models.Employee.department.ilike(f"%{keyword}%"),
             models.Employee.position.ilike(f"%{keyword}%")
         )
-    ).all()
+    ), skip=skip, limit=limit)
 
-def get_by_department(db: Session, department: str):
+def get_by_department(db: Session, department: str, skip: int = 0, limit: int = None):
     """Get all employees in a specific department"""
-    return db.query(models.Employee).filter(models.Employee.department == department).all()
+    return _query_all(
+        db, lambda session: session.query(models.Employee).filter(models.Employee.department == department),
+        skip=skip, limit=limit
+    )
 
 def get_by_position(db: Session, position: str):
     """Get all employees with a specific position"""
-    return db.query(models.Employee).filter(models.Employee.position == position).all()
\ No newline at end of file
+    return _query_all(db, lambda session: session.query(models.Employee).filter(models.Employee.position == position))
@@ -6,14 +6,65 @@ from dotenv import load_dotenv
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Comma-separated database URLs; when set, employees are spread across them
+SHARD_DATABASE_URLS = [url.strip() for url in os.getenv("SHARD_DATABASE_URLS", "").split(",") if url.strip()]
 
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+shard_engines = [create_engine(url) for url in SHARD_DATABASE_URLS]
+ShardSessionLocals = [sessionmaker(autocommit=False, autoflush=False, bind=shard_engine) for shard_engine in shard_engines]
+
 Base = declarative_base()
 
+class ShardedSession:
+    """One session per shard, opened on first use; stands in for a Session when sharding is on"""
+
+    def __init__(self, session_factories=None):
+        self.session_factories = session_factories if session_factories is not None else ShardSessionLocals
+        self._sessions = {}
+
+    def __len__(self):
+        return len(self.session_factories)
+
+    def shard(self, index):
+        session = self._sessions.get(index)
+        if session is None:
+            session = self._sessions[index] = self.session_factories[index]()
+        return session
+
+    def all(self):
+        return [self.shard(index) for index in range(len(self))]
+
+    def commit(self):
+        for session in self._sessions.values():
+            session.commit()
+
+    def rollback(self):
+        for session in self._sessions.values():
+            session.rollback()
+
+    def close(self):
+        for session in self._sessions.values():
+            session.close()
+        self._sessions = {}
+
+def employee_session():
+    """Session for employee data: sharded when shards are configured"""
+    return ShardedSession() if ShardSessionLocals else SessionLocal()
+
+def employee_session_factories():
+    return ShardSessionLocals or [SessionLocal]
+
 def get_db():
     db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def get_employee_db():
+    db = employee_session()
     try:
         yield db
     finally:
@@ -0,0 +1,485 @@
+"""Background jobs for bulk imports and exports.
+
+A request submits a job and gets its ID back straight away. Import uploads
+are streamed to a staging file first, so the request never holds or stores
+the whole body. The job runs in
+a small thread pool (DB I/O) in chunks, hands CPU-bound row validation to a
+process pool, and records progress and a checkpoint after every chunk so a
+cancelled or failed job can be resumed where it stopped.
+
+Each process renews a heartbeat on the jobs it owns. A job whose heartbeat is
+older than the lease belongs to a process that is gone, and any process fails
+it so it can be resumed. Jobs owned by live processes are left alone.
+"""
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from itertools import count, islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+from sqlalchemy import or_
+from app import crud, models, schemas
+from app.database import SessionLocal, ShardSessionLocals, ShardedSession
+
+CHUNK_SIZE = int(os.getenv("JOB_CHUNK_SIZE", "1000"))
+# Keep this well under the DB pool size so API requests still get connections
+MAX_CONCURRENT_JOBS = int(os.getenv("JOB_MAX_CONCURRENT", "2"))
+MAX_QUEUED_JOBS = int(os.getenv("JOB_QUEUE_LIMIT", "20"))
+# 0 validates rows in the job thread instead of a process pool
+PROCESS_WORKERS = int(os.getenv("JOB_PROCESS_WORKERS", "2"))
+EXPORT_DIR = os.getenv("JOB_EXPORT_DIR", "exports")
+UPLOAD_DIR = os.getenv("JOB_UPLOAD_DIR", "uploads")
+# Larger import uploads are rejected with 413
+MAX_UPLOAD_BYTES = int(os.getenv("JOB_MAX_UPLOAD_BYTES", str(1024 ** 3)))
+# Uploads of failed or cancelled imports not resumed for this long are deleted
+UPLOAD_TTL_SECONDS = float(os.getenv("JOB_UPLOAD_TTL_SECONDS", str(24 * 60 * 60)))
+# A job whose owner has not renewed its heartbeat for this long is failed
+LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+MAX_STORED_ERRORS = 1000
+
+RESUMABLE_STATUSES = ("failed", "cancelled")
+ACTIVE_STATUSES = ("queued", "running", "cancelling")
+EXPORT_FIELDS = [
+    "id", "first_name", "last_name", "email", "phone", "department",
+    "position", "salary", "hire_date", "created_at", "updated_at",
+]
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _validate_chunk(start, lines):
+    """Parse and validate raw NDJSON import lines; runs in a worker process"""
+    valid = []
+    errors = []
+    for index, line in enumerate(lines, start=start):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            errors.append({"row": index, "error": f"Invalid JSON: {e}"})
+            continue
+        try:
+            valid.append((index, schemas.EmployeeCreate.model_validate(row).model_dump()))
+        except ValidationError as e:
+            message = "; ".join(
+                f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in e.errors()
+            )
+            errors.append({"row": index, "error": message})
+    return valid, errors
+
+
+def job_to_dict(job):
+    progress = round(job.processed * 100 / job.total, 2) if job.total else 0
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "total": job.total,
+        "processed": job.processed,
+        "failed": job.failed,
+        "progress": progress,
+        "errors": job.errors or [],
+        "result": job.result,
+        "error": job.error,
+        "created_at": str(job.created_at),
+        "updated_at": str(job.updated_at) if job.updated_at else None
+    }
+
+
+class JobManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # One entry per run, keyed by a token, so a finishing run only releases its own slot
+        self._active = {}
+        self._tokens = count()
+        self._stopping = threading.Event()
+        # Identifies this process as the owner of the jobs it runs
+        self.instance_id = uuid.uuid4().hex
+        self._heartbeat = None
+        self._threads = None
+        self._processes = None
+
+    def _thread_pool(self):
+        with self._lock:
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(
+                    max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix="job"
+                )
+            return self._threads
+
+    def _process_pool(self):
+        if PROCESS_WORKERS <= 0:
+            return None
+        with self._lock:
+            if self._processes is None:
+                # Forking a process that already runs threads is unsafe
+                self._processes = ProcessPoolExecutor(
+                    max_workers=PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._processes
+
+    def _reserve(self, job_id):
+        """Take a queue slot for one run of the job; returns the token that releases it"""
+        with self._lock:
+            if len(self._active) >= MAX_QUEUED_JOBS:
+                raise HTTPException(status_code=429, detail="Too many jobs in progress, try again later")
+            token = next(self._tokens)
+            self._active[token] = job_id
+            return token
+
+    def _release(self, token):
+        with self._lock:
+            self._active.pop(token, None)
+
+    def check_capacity(self):
+        """Reject early, before a large upload is read"""
+        with self._lock:
+            if len(self._active) >= MAX_QUEUED_JOBS:
+                raise HTTPException(status_code=429, detail="Too many jobs in progress, try again later")
+
+    async def stage_upload(self, stream):
+        """Write an NDJSON upload to the staging dir and count its lines.
+
+        Returns the file path and the number of rows.
+        """
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.ndjson")
+        rows = 0
+        size = 0
+        last = b"\n"
+        try:
+            with open(path, "wb") as f:
+                async for chunk in stream:
+                    if not chunk:
+                        continue
+                    size += len(chunk)
+                    if size > MAX_UPLOAD_BYTES:
+                        raise HTTPException(status_code=413, detail="Upload is too large")
+                    f.write(chunk)
+                    rows += chunk.count(b"\n")
+                    last = chunk[-1:]
+                if last != b"\n":
+                    f.write(b"\n")
+                    rows += 1
+        except BaseException:
+            # Covers client disconnects and cancellation as well as the size cap
+            os.remove(path)
+            raise
+        if rows == 0:
+            os.remove(path)
+            raise HTTPException(status_code=400, detail="Upload is empty")
+        return path, rows
+
+    def submit(self, db, kind, payload, total=0):
+        job = models.Job(
+            id=uuid.uuid4().hex, kind=kind, status="queued", payload=payload,
+            total=total, processed=0, failed=0, errors=[],
+            owner=self.instance_id, heartbeat_at=_now()
+        )
+        token = self._reserve(job.id)
+        try:
+            db.add(job)
+            db.commit()
+            db.refresh(job)
+        except Exception:
+            self._release(token)
+            raise
+        self._thread_pool().submit(self._run, job.id, token)
+        return job
+
+    def get(self, db, job_id):
+        job = db.query(models.Job).filter(models.Job.id == job_id).first()
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return job
+
+    def cancel(self, db, job_id):
+        # The worker notices this at the next chunk boundary
+        if not self._transition(db, job_id, ("queued", "running"), "cancelling"):
+            job = self.get(db, job_id)
+            raise HTTPException(status_code=409, detail=f"Job is already {job.status}")
+        db.commit()
+        return self.get(db, job_id)
+
+    def resume(self, db, job_id):
+        token = self._reserve(job_id)
+        try:
+            # Only one caller can move the job out of a resumable status
+            if not self._transition(
+                db, job_id, RESUMABLE_STATUSES, "queued",
+                error=None, owner=self.instance_id, heartbeat_at=_now()
+            ):
+                job = self.get(db, job_id)
+                raise HTTPException(status_code=409, detail=f"Cannot resume a job that is {job.status}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            self._release(token)
+            raise
+        self._thread_pool().submit(self._run, job_id, token)
+        return self.get(db, job_id)
+
+    def start(self):
+        """Fail abandoned jobs, then keep this process's leases renewed in the background"""
+        self.recover()
+        self.expire_uploads()
+        self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def recover(self):
+        """Fail active jobs whose owner stopped renewing their lease, so they can be resumed"""
+        db = SessionLocal()
+        try:
+            expired = _now() - timedelta(seconds=LEASE_SECONDS)
+            db.query(models.Job).filter(
+                models.Job.status.in_(ACTIVE_STATUSES),
+                or_(models.Job.owner.is_(None), models.Job.owner != self.instance_id),
+                or_(models.Job.heartbeat_at.is_(None), models.Job.heartbeat_at < expired)
+            ).update(
+                {"status": "failed", "error": "Its worker stopped responding; resume to continue"},
+                synchronize_session=False
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def renew(self):
+        """Move the heartbeat of every active job this process owns"""
+        db = SessionLocal()
+        try:
+            db.query(models.Job).filter(
+                models.Job.owner == self.instance_id, models.Job.status.in_(ACTIVE_STATUSES)
+            ).update({"heartbeat_at": _now()}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def expire_uploads(self):
+        """Delete the staged uploads of imports left failed or cancelled past the TTL.
+
+        The jobs move to "expired" first, so nothing can resume them afterwards.
+        """
+        db = SessionLocal()
+        try:
+            cutoff = _now() - timedelta(seconds=UPLOAD_TTL_SECONDS)
+            stale = db.query(models.Job.id, models.Job.payload).filter(
+                models.Job.kind == "import",
+                models.Job.status.in_(RESUMABLE_STATUSES),
+                models.Job.heartbeat_at < cutoff
+            ).all()
+            for job_id, payload in stale:
+                if not self._transition(db, job_id, RESUMABLE_STATUSES, "expired", error="Upload expired"):
+                    continue
+                db.commit()
+                try:
+                    os.remove(payload["file"])
+                except FileNotFoundError:
+                    pass
+        finally:
+            db.close()
+
+    def _heartbeat_loop(self):
+        while not self._stopping.wait(LEASE_SECONDS / 4):
+            try:
+                self.renew()
+                self.recover()
+                self.expire_uploads()
+            except Exception:
+                logger.exception("Job heartbeat failed")
+
+    def shutdown(self):
+        """Stop running jobs at their next checkpoint and release the pools"""
+        self._stopping.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        if self._threads is not None:
+            # Queued jobs still start, see the stop flag and record themselves as cancelled
+            self._threads.shutdown(wait=True)
+        if self._processes is not None:
+            self._processes.shutdown(wait=True, cancel_futures=True)
+
+    def _transition(self, db, job_id, from_statuses, status, **values):
+        """Set the status only if the job is still in one of from_statuses"""
+        updated = db.query(models.Job).filter(
+            models.Job.id == job_id, models.Job.status.in_(from_statuses)
+        ).update(dict(values, status=status), synchronize_session=False)
+        return updated == 1
+
+    def _checkpoint(self, db, job_id, **values):
+        """Record progress; stops the job if something else took it over"""
+        # A chunk already in flight when a cancel arrives still gets recorded
+        updated = db.query(models.Job).filter(
+            models.Job.id == job_id, models.Job.status.in_(("running", "cancelling"))
+        ).update(values, synchronize_session=False)
+        if updated != 1:
+            raise JobCancelled()
+
+    def _check_cancelled(self, db, job_id):
+        status = db.query(models.Job.status).filter(models.Job.id == job_id).scalar()
+        if status != "running" or self._stopping.is_set():
+            raise JobCancelled()
+
+    def _run(self, job_id, token):
+        db = SessionLocal()
+        # Job rows stay on the main DB; employees may be sharded
+        employee_db = ShardedSession() if ShardSessionLocals else db
+        try:
+            if self._stopping.is_set() or not self._transition(db, job_id, ("queued",), "running"):
+                raise JobCancelled()
+            db.commit()
+            job = db.query(models.Job).filter(models.Job.id == job_id).first()
+
+            if job.kind == "import":
+                self._run_import(db, employee_db, job)
+            elif job.kind == "export":
+                self._run_export(db, employee_db, job)
+            else:
+                raise ValueError(f"Unknown job kind: {job.kind}")
+
+            # A cancel that arrives after the last chunk is too late to matter
+            completed = self._transition(db, job_id, ("running", "cancelling"), "completed")
+            # Free the slot before the final status is visible, so a caller that sees it can submit again
+            self._release(token)
+            db.commit()
+            if completed and job.kind == "import":
+                os.remove(job.payload["file"])
+        except JobCancelled:
+            employee_db.rollback()
+            db.rollback()
+            # A no-op if the job was not ours to cancel (e.g. it was already failed)
+            self._transition(db, job_id, ACTIVE_STATUSES, "cancelled")
+            self._release(token)
+            db.commit()
+        except Exception as e:
+            employee_db.rollback()
+            db.rollback()
+            self._transition(db, job_id, ACTIVE_STATUSES, "failed", error=str(e))
+            self._release(token)
+            db.commit()
+        finally:
+            if employee_db is not db:
+                employee_db.close()
+            db.close()
+            self._release(token)
+
+    def _validated_chunks(self, f, row):
+        """Yield validated chunks, keeping the next chunk validating while one is written.
+
+        Yields the next row number, the file offset after the chunk and the validation result.
+        """
+        pool = self._process_pool()
+        pending = deque()
+        offset = f.tell()
+        try:
+            while True:
+                lines = list(islice(f, CHUNK_SIZE))
+                if not lines:
+                    break
+                begin = row
+                row += len(lines)
+                offset += sum(len(line) for line in lines)
+                if pool is None:
+                    yield row, offset, _validate_chunk(begin, lines)
+                    continue
+                pending.append((row, offset, pool.submit(_validate_chunk, begin, lines)))
+                if len(pending) > 1:
+                    end, end_offset, future = pending.popleft()
+                    yield end, end_offset, future.result()
+            while pending:
+                end, end_offset, future = pending.popleft()
+                yield end, end_offset, future.result()
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+
+    def _run_import(self, db, employee_db, job):
+        checkpoint = job.checkpoint or {"next_row": 0, "offset": 0}
+        failed = job.failed
+        errors = list(job.errors or [])
+        imported = (job.result or {}).get("imported", 0)
+
+        with open(job.payload["file"], "rb") as f:
+            f.seek(checkpoint["offset"])
+            for end, offset, (valid, chunk_errors) in self._validated_chunks(f, checkpoint["next_row"]):
+                self._check_cancelled(db, job.id)
+
+                # Earlier chunks are already committed, so the DB catches duplicates across chunks
+                # Shards commit inside create_employees_bulk; rows they already hold
+                # show up as duplicate emails if the chunk is retried after a crash
+                created, duplicates = crud.create_employees_bulk(employee_db, valid)
+                chunk_errors += duplicates
+                failed += len(chunk_errors)
+                imported += created
+                errors = (errors + sorted(chunk_errors, key=lambda err: err["row"]))[:MAX_STORED_ERRORS]
+
+                # Without sharding, rows and checkpoint commit together, so a resumed job never re-imports a chunk
+                self._checkpoint(
+                    db, job.id, processed=end, failed=failed, errors=errors,
+                    checkpoint={"next_row": end, "offset": offset}, result={"imported": imported}
+                )
+                db.commit()
+
+    def _run_export(self, db, employee_db, job):
+        department = (job.payload or {}).get("department")
+        checkpoint = job.checkpoint or {"last_id": 0, "offset": 0}
+        columns = [getattr(models.Employee, field) for field in EXPORT_FIELDS]
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        path = os.path.join(EXPORT_DIR, f"{job.id}.csv")
+
+        if not job.checkpoint:
+            total = crud.count_employees(employee_db, department=department)
+            self._checkpoint(db, job.id, total=total, result={"file": path, "rows": 0})
+            db.commit()
+
+        mode = "r+" if checkpoint["offset"] else "w"
+        with open(path, mode, newline="", encoding="utf-8") as f:
+            # Drop anything written after the last committed checkpoint
+            f.seek(checkpoint["offset"])
+            f.truncate()
+            writer = csv.writer(f)
+            if checkpoint["offset"] == 0:
+                writer.writerow(EXPORT_FIELDS)
+
+            last_id = checkpoint["last_id"]
+            processed = job.processed
+            while True:
+                self._check_cancelled(db, job.id)
+                rows = crud.get_employee_rows(
+                    employee_db, columns, after_id=last_id, limit=CHUNK_SIZE, department=department
+                )
+                if not rows:
+                    break
+
+                writer.writerows(rows)
+                f.flush()
+                os.fsync(f.fileno())
+                last_id = rows[-1].id
+                processed += len(rows)
+                self._checkpoint(
+                    db, job.id, processed=processed,
+                    checkpoint={"last_id": last_id, "offset": f.tell()},
+                    result={"file": path, "rows": processed}
+                )
+                db.commit()
+
+
+manager = JobManager()
@@ -1,18 +1,44 @@
-from fastapi import FastAPI, Depends
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
 from sqlalchemy.orm import Session
-from typing import List
-from app import models, schemas, crud
-from app.database import engine, get_db
+from typing import List, Optional
+import os
+from app import models, schemas, crud, jobs, sharding
+from app.snapshot import read_snapshot
+from app.database import engine, shard_engines, get_db, get_employee_db
 
-# Create tables
-models.Base.metadata.create_all(bind=engine, checkfirst=True)
+# Create tables; with sharding the employee tables live on the shards only
+main_tables = [models.Job.__table__]
+if not shard_engines:
+    main_tables.append(models.Employee.__table__)
+models.Base.metadata.create_all(bind=engine, tables=main_tables, checkfirst=True)
+for shard_engine in shard_engines:
+    sharding.init_shard(shard_engine)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    jobs.manager.start()
+    if read_snapshot is not None:
+        read_snapshot.start()
+    yield
+    if read_snapshot is not None:
+        read_snapshot.stop()
+    # Let running jobs checkpoint before the process exits
+    jobs.manager.shutdown()
 
 app = FastAPI(
     title="Employee Management API - Assignment",
     description="RESTful API for Employee CRUD Operations",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
+def use_snapshot():
+    """Serve reads from the in-memory snapshot once it has loaded"""
+    return read_snapshot is not None and read_snapshot.loaded
+
 @app.get("/", tags=["Root"])
 def read_root():
     return {
@@ -22,9 +48,11 @@ def read_root():
     }
 
 @app.post("/api/v1/employees", status_code=201, tags=["Employees"])
-def create_employee(employee: schemas.EmployeeCreate, db: Session = Depends(get_db)):
+def create_employee(employee: schemas.EmployeeCreate, db: Session = Depends(get_employee_db)):
     """Create a new employee"""
     db_employee = crud.create_employee(db=db, employee=employee)
+    if read_snapshot is not None:
+        read_snapshot.apply(db_employee)
     
     # Manually convert to dict
     return {
@@ -46,8 +74,15 @@ def create_employee(employee: schemas.EmployeeCreate, db: Session = Depends(get_
     }
 
 @app.get("/api/v1/employees", tags=["Employees"])
-def get_all_employees(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def get_all_employees(skip: int = 0, limit: int = 100, db: Session = Depends(get_employee_db)):
     """Get all employees with pagination"""
+    if use_snapshot():
+        return {
+            "success": True,
+            "message": "Employees retrieved successfully",
+            "data": read_snapshot.page(skip=skip, limit=limit)
+        }
+    
     employees = crud.get_employees(db, skip=skip, limit=limit)
     
     # Convert list of employees to dicts
@@ -74,8 +109,18 @@ def get_all_employees(skip: int = 0, limit: int = 100, db: Session = Depends(get
     }
 
 @app.get("/api/v1/employees/{employee_id}", tags=["Employees"])
-def get_employee(employee_id: int, db: Session = Depends(get_db)):
+def get_employee(employee_id: int, db: Session = Depends(get_employee_db)):
     """Get a specific employee by ID"""
+    if use_snapshot():
+        data = read_snapshot.get(employee_id)
+        if data is None:
+            raise HTTPException(status_code=404, detail="Employee not found")
+        return {
+            "success": True,
+            "message": "Employee retrieved successfully",
+            "data": data
+        }
+    
     emp = crud.get_employee(db, employee_id=employee_id)
     
     return {
@@ -97,9 +142,11 @@ def get_employee(employee_id: int, db: Session = Depends(get_db)):
     }
 
 @app.put("/api/v1/employees/{employee_id}", tags=["Employees"])
-def update_employee(employee_id: int, employee: schemas.EmployeeUpdate, db: Session = Depends(get_db)):
+def update_employee(employee_id: int, employee: schemas.EmployeeUpdate, db: Session = Depends(get_employee_db)):
     """Update an existing employee"""
     db_employee = crud.update_employee(db, employee_id=employee_id, employee=employee)
+    if read_snapshot is not None:
+        read_snapshot.apply(db_employee)
     
     return {
         "success": True,
@@ -120,15 +167,17 @@ def update_employee(employee_id: int, employee: schemas.EmployeeUpdate, db: Sess
     }
 
 @app.delete("/api/v1/employees/{employee_id}", tags=["Employees"])
-def delete_employee(employee_id: int, db: Session = Depends(get_db)):
+def delete_employee(employee_id: int, db: Session = Depends(get_employee_db)):
     """Delete an employee"""
     result = crud.delete_employee(db, employee_id=employee_id)
+    if read_snapshot is not None:
+        read_snapshot.remove(employee_id)
     return result
 
 @app.get("/api/v1/employees/search/query", tags=["Employees"])
-def search_employees(keyword: str, db: Session = Depends(get_db)):
+def search_employees(keyword: str, skip: int = 0, limit: Optional[int] = None, db: Session = Depends(get_employee_db)):
     """Search employees by keyword"""
-    employees = crud.search_employees(db, keyword=keyword)
+    employees = crud.search_employees(db, keyword=keyword, skip=skip, limit=limit)
     
     employee_list = []
     for emp in employees:
@@ -153,9 +202,16 @@ def search_employees(keyword: str, db: Session = Depends(get_db)):
     }
 
 @app.get("/api/v1/employees/department/{department}", tags=["Employees"])
-def get_by_department(department: str, db: Session = Depends(get_db)):
+def get_by_department(department: str, skip: int = 0, limit: Optional[int] = None, db: Session = Depends(get_employee_db)):
     """Get employees by department"""
-    employees = crud.get_by_department(db, department=department)
+    if use_snapshot():
+        return {
+            "success": True,
+            "message": f"Employees in {department} retrieved successfully",
+            "data": read_snapshot.by_department(department, skip=skip, limit=limit)
+        }
+    
+    employees = crud.get_by_department(db, department=department, skip=skip, limit=limit)
     
     employee_list = []
     for emp in employees:
@@ -177,4 +233,89 @@ def get_by_department(department: str, db: Session = Depends(get_db)):
         "success": True,
         "message": f"Employees in {department} retrieved successfully",
         "data": employee_list
+    }
+
+@app.post("/api/v1/jobs/import", status_code=202, tags=["Jobs"])
+async def submit_import_job(request: Request, db: Session = Depends(get_db)):
+    """Submit a bulk employee import to run in the background.
+
+    The body is NDJSON: one employee object per line. It is streamed to a
+    staging file rather than parsed here.
+    """
+    jobs.manager.check_capacity()
+    path, rows = await jobs.manager.stage_upload(request.stream())
+    try:
+        job = await run_in_threadpool(jobs.manager.submit, db, "import", {"file": path}, rows)
+    except Exception:
+        os.remove(path)
+        raise
+    
+    return {
+        "success": True,
+        "message": "Import job submitted",
+        "data": jobs.job_to_dict(job)
+    }
+
+@app.post("/api/v1/jobs/export", status_code=202, tags=["Jobs"])
+def submit_export_job(request: schemas.ExportJobRequest, db: Session = Depends(get_db)):
+    """Submit a CSV export of employees to run in the background"""
+    job = jobs.manager.submit(db, "export", request.model_dump())
+    
+    return {
+        "success": True,
+        "message": "Export job submitted",
+        "data": jobs.job_to_dict(job)
+    }
+
+@app.get("/api/v1/jobs/{job_id}", tags=["Jobs"])
+def get_job(job_id: str, db: Session = Depends(get_db)):
+    """Get the status and progress of a job"""
+    job = jobs.manager.get(db, job_id)
+    
+    return {
+        "success": True,
+        "message": "Job retrieved successfully",
+        "data": jobs.job_to_dict(job)
+    }
+
+@app.get("/api/v1/jobs/{job_id}/result", tags=["Jobs"])
+def get_job_result(job_id: str, db: Session = Depends(get_db)):
+    """Get the result of a completed job (CSV file for exports)"""
+    job = jobs.manager.get(db, job_id)
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}, result not available")
+    
+    if job.kind == "export":
+        return FileResponse(job.result["file"], media_type="text/csv", filename=f"employees_{job.id}.csv")
+    
+    return {
+        "success": True,
+        "message": "Job result retrieved successfully",
+        "data": {
+            "imported": job.result["imported"] if job.result else 0,
+            "failed": job.failed,
+            "errors": job.errors or []
+        }
+    }
+
+@app.post("/api/v1/jobs/{job_id}/cancel", tags=["Jobs"])
+def cancel_job(job_id: str, db: Session = Depends(get_db)):
+    """Cancel a queued or running job at its next checkpoint"""
+    job = jobs.manager.cancel(db, job_id)
+    
+    return {
+        "success": True,
+        "message": "Job cancellation requested",
+        "data": jobs.job_to_dict(job)
+    }
+
+@app.post("/api/v1/jobs/{job_id}/resume", tags=["Jobs"])
+def resume_job(job_id: str, db: Session = Depends(get_db)):
+    """Resume a cancelled or failed job from its last checkpoint"""
+    job = jobs.manager.resume(db, job_id)
+    
+    return {
+        "success": True,
+        "message": "Job resumed",
+        "data": jobs.job_to_dict(job)
     }
\ No newline at end of file
@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, Date, Float, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, Date, Float, DateTime, Text, JSON
 from sqlalchemy.sql import func
+from datetime import datetime, timezone
 from app.database import Base
 
 class Employee(Base):
@@ -15,4 +16,42 @@ class Employee(Base):
     salary = Column(Float)
     hire_date = Column(Date)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
\ No newline at end of file
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(String(32), primary_key=True)
+    kind = Column(String(20), nullable=False)
+    status = Column(String(20), nullable=False, index=True)
+    # Job options; imports point at their staged upload file here
+    payload = Column(JSON)
+    total = Column(Integer, default=0)
+    processed = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    checkpoint = Column(JSON)
+    errors = Column(JSON)
+    result = Column(JSON)
+    error = Column(Text)
+    # The process running the job renews heartbeat_at (naive UTC) while it is active
+    owner = Column(String(32))
+    heartbeat_at = Column(DateTime)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+class EmployeeEmail(Base):
+    """Email directory used when sharding; each email lives on the shard its hash picks"""
+    __tablename__ = "employee_emails"
+
+    email = Column(String(100), primary_key=True)
+    employee_id = Column(Integer, nullable=False)
+    # Naive UTC, set in Python so it compares the same way on every shard
+    claimed_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+
+
+class EmployeeIdSequence(Base):
+    """Per-shard ID counter used when sharding; a single row, see sharding.allocate_ids"""
+    __tablename__ = "employee_id_sequence"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    next_value = Column(BigInteger, nullable=False)
\ No newline at end of file
@@ -92,4 +92,7 @@ class EmployeeResponse(EmployeeBase):
 class ApiResponse(BaseModel):
     success: bool
     message: str
-    data: Optional[Any] = None
\ No newline at end of file
+    data: Optional[Any] = None
+
+class ExportJobRequest(BaseModel):
+    department: Optional[str] = Field(None, max_length=50, description="Only export this department")
@@ -0,0 +1,108 @@
+"""Routing helpers for employees spread across several databases.
+
+Each employee lives on exactly one shard:
+
+- A new employee is placed on the shard picked by a stable hash of its email,
+  so the row and its entry in the email directory commit together.
+- IDs are allocated from that shard's own sequence as ``seq * N + shard``, so
+  IDs never collide across shards and ``id % N`` always finds the row again.
+- Email uniqueness is checked in the email directory on the email's shard.
+
+The directory and the employee rows live on different shards, so they are
+not updated atomically. An email change claims the new email first, then
+updates the row, then releases the old email. A crash or a failed release
+can leave an entry whose employee no longer uses that email. Such an entry
+is stale. Once it is older than CLAIM_GRACE, the next caller that wants the
+email takes it over, so a lost release never reserves an email for good.
+
+The shard count must not change once data has been written.
+"""
+import hashlib
+import heapq
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import insert, select
+
+from app import models
+
+# Shared by every request and job; size it for shard count x concurrent fan-out callers
+FANOUT_WORKERS = int(os.getenv("SHARD_FANOUT_WORKERS", "32"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# A claim this young may belong to an email change that has not committed yet
+CLAIM_GRACE = timedelta(seconds=60)
+
+
+def shard_for_id(employee_id, shard_count):
+    return employee_id % shard_count
+
+
+def shard_for_email(email, shard_count):
+    # hash() is randomised per process, so use a digest that is stable everywhere
+    digest = hashlib.sha1(email.lower().encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
+
+
+_COUNTER_ID = 1
+_EMPLOYEE_TABLES = [models.Employee.__table__, models.EmployeeEmail.__table__, models.EmployeeIdSequence.__table__]
+
+
+def init_shard(engine):
+    """Create the employee tables on a shard and seed its ID counter"""
+    models.Base.metadata.create_all(bind=engine, tables=_EMPLOYEE_TABLES, checkfirst=True)
+    with engine.begin() as connection:
+        seeded = connection.execute(
+            select(models.EmployeeIdSequence.id).where(models.EmployeeIdSequence.id == _COUNTER_ID)
+        ).first()
+        if seeded is None:
+            connection.execute(insert(models.EmployeeIdSequence).values(id=_COUNTER_ID, next_value=1))
+
+
+def allocate_ids(session, shard, shard_count, count):
+    """Reserve count new employee IDs that all route to shard.
+
+    One UPDATE reserves the whole block. It keeps the counter row locked
+    until the caller commits, so allocations on a shard never overlap.
+    """
+    counter = models.EmployeeIdSequence
+    session.query(counter).filter(counter.id == _COUNTER_ID).update(
+        {counter.next_value: counter.next_value + count}, synchronize_session=False
+    )
+    end = session.query(counter.next_value).filter(counter.id == _COUNTER_ID).scalar()
+    return [value * shard_count + shard for value in range(end - count, end)]
+
+
+def claim_is_recent(claimed_at):
+    return claimed_at > datetime.now(timezone.utc).replace(tzinfo=None) - CLAIM_GRACE
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="shard")
+        return _pool
+
+
+def fan_out(db, query):
+    """Run query(session) on every shard in parallel and return the results in shard order"""
+    # Open the sessions here so each worker thread only ever touches its own session
+    sessions = db.all()
+    if len(sessions) == 1:
+        return [query(sessions[0])]
+    futures = [_executor().submit(query, session) for session in sessions]
+    # Let every shard finish before raising, so no thread still uses a session the caller closes
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+def merge_by_id(results, skip=0, limit=None):
+    """Merge per-shard lists that are each sorted by id and cut out one page"""
+    rows = list(heapq.merge(*results, key=lambda row: row.id))
+    skip = max(skip, 0)
+    return rows[skip:] if limit is None else rows[skip:skip + max(limit, 0)]
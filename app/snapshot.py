@@ -0,0 +1,366 @@
+"""Read-only in-memory employee snapshot for read-mostly deployments.
+
+The employees table is held column by column: numeric and date columns in
+typed arrays, department and position as codes into one interned string
+table, and hash indexes on id, email and department. Reads never touch the
+DB or build ORM objects. A background thread pulls changed rows by
+created_at/updated_at, and writes made through this process are applied
+straight away.
+"""
+import logging
+import math
+import os
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy import func, or_
+
+from app import models
+from app.database import employee_session_factories
+
+SNAPSHOT_ENABLED = os.getenv("READ_SNAPSHOT", "false").lower() in ("1", "true", "yes")
+REFRESH_SECONDS = float(os.getenv("SNAPSHOT_REFRESH_SECONDS", "5"))
+# Re-read rows this far behind the newest timestamp seen, so rows committed
+# late with an earlier timestamp are not missed
+REFRESH_OVERLAP = timedelta(seconds=30)
+
+# Ids per query when fetching rows the timestamp window missed
+_FETCH_BATCH = 500
+
+_NULL = -(2 ** 63)
+_NO_CODE = -1
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+_COLUMNS = [
+    models.Employee.id, models.Employee.first_name, models.Employee.last_name,
+    models.Employee.email, models.Employee.phone, models.Employee.department,
+    models.Employee.position, models.Employee.salary, models.Employee.hire_date,
+    models.Employee.created_at, models.Employee.updated_at,
+]
+
+logger = logging.getLogger(__name__)
+
+
+def _encode_datetime(value):
+    if value is None:
+        return _NULL
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - _EPOCH) // _MICROSECOND
+
+
+def _decode_datetime(value):
+    return None if value == _NULL else _EPOCH + timedelta(microseconds=value)
+
+
+class _SortedRows:
+    """Row numbers kept sorted by employee id, with a parallel array of ids to bisect"""
+
+    __slots__ = ("ids", "rows")
+
+    def __init__(self):
+        self.ids = array("q")
+        self.rows = array("q")
+
+    def add(self, employee_id, index):
+        # New ids are usually the largest yet, which is a plain append
+        if not self.ids or employee_id > self.ids[-1]:
+            self.ids.append(employee_id)
+            self.rows.append(index)
+            return
+        position = bisect_left(self.ids, employee_id)
+        if position < len(self.ids) and self.ids[position] == employee_id:
+            self.rows[position] = index
+            return
+        self.ids.insert(position, employee_id)
+        self.rows.insert(position, index)
+
+    def discard(self, employee_id):
+        position = bisect_left(self.ids, employee_id)
+        if position < len(self.ids) and self.ids[position] == employee_id:
+            del self.ids[position]
+            del self.rows[position]
+
+    def page(self, skip=0, limit=None):
+        skip = max(skip, 0)
+        return self.rows[skip:] if limit is None else self.rows[skip:skip + max(limit, 0)]
+
+
+class EmployeeSnapshot:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._strings = []
+        self._codes = {}
+        self._watermark = None
+        self.loaded = False
+        self._clear()
+
+    def _clear(self):
+        self._ids = array("q")
+        self._first_names = []
+        self._last_names = []
+        self._emails = []
+        self._phones = []
+        self._departments = array("i")
+        self._positions = array("i")
+        self._salaries = array("d")
+        self._hire_dates = array("i")
+        self._created_at = array("q")
+        self._updated_at = array("q")
+        self._dead = 0
+        self._by_id = {}
+        self._by_email = {}
+        # Live rows sorted by id, overall and per department code. They are
+        # kept sorted on every change so reads never have to sort.
+        self._order = _SortedRows()
+        self._by_department = {}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def _code(self, value):
+        if value is None:
+            return _NO_CODE
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self._strings)
+            self._strings.append(sys.intern(value))
+            self._codes[value] = code
+        return code
+
+    def _string(self, code):
+        return None if code == _NO_CODE else self._strings[code]
+
+    def _department_rows(self, code):
+        rows = self._by_department.get(code)
+        if rows is None:
+            rows = self._by_department[code] = _SortedRows()
+        return rows
+
+    def _apply_row(self, row, update_indexes=True):
+        """Insert or update one row; takes ORM objects or result rows"""
+        department = self._code(row.department)
+        index = self._by_id.get(row.id)
+        if index is None:
+            index = len(self._ids)
+            self._ids.append(row.id)
+            self._first_names.append(sys.intern(row.first_name))
+            self._last_names.append(sys.intern(row.last_name))
+            self._emails.append(row.email)
+            self._phones.append(row.phone)
+            self._departments.append(department)
+            self._positions.append(self._code(row.position))
+            self._salaries.append(math.nan if row.salary is None else row.salary)
+            self._hire_dates.append(row.hire_date.toordinal() if row.hire_date else 0)
+            self._created_at.append(_encode_datetime(row.created_at))
+            self._updated_at.append(_encode_datetime(row.updated_at))
+            self._by_id[row.id] = index
+            self._by_email[row.email] = index
+
+            if update_indexes:
+                self._order.add(row.id, index)
+                self._department_rows(department).add(row.id, index)
+        else:
+            if self._emails[index] != row.email:
+                if self._by_email.get(self._emails[index]) == index:
+                    del self._by_email[self._emails[index]]
+                self._by_email[row.email] = index
+                self._emails[index] = row.email
+            if self._departments[index] != department:
+                if update_indexes:
+                    self._department_rows(self._departments[index]).discard(row.id)
+                    self._department_rows(department).add(row.id, index)
+                self._departments[index] = department
+            self._first_names[index] = sys.intern(row.first_name)
+            self._last_names[index] = sys.intern(row.last_name)
+            self._phones[index] = row.phone
+            self._positions[index] = self._code(row.position)
+            self._salaries[index] = math.nan if row.salary is None else row.salary
+            self._hire_dates[index] = row.hire_date.toordinal() if row.hire_date else 0
+            self._created_at[index] = _encode_datetime(row.created_at)
+            self._updated_at[index] = _encode_datetime(row.updated_at)
+
+        for seen in (row.created_at, row.updated_at):
+            if seen is not None and (self._watermark is None or seen > self._watermark):
+                self._watermark = seen
+
+    def _remove(self, employee_id):
+        index = self._by_id.pop(employee_id, None)
+        if index is None:
+            return
+        if self._by_email.get(self._emails[index]) == index:
+            del self._by_email[self._emails[index]]
+        self._order.discard(employee_id)
+        self._department_rows(self._departments[index]).discard(employee_id)
+        self._first_names[index] = self._last_names[index] = None
+        self._emails[index] = self._phones[index] = None
+        self._dead += 1
+
+    def _build_indexes(self):
+        """Sort all rows into the indexes; only used while loading"""
+        self._order = _SortedRows()
+        self._by_department = {}
+        for index in sorted(self._by_id.values(), key=self._ids.__getitem__):
+            self._order.add(self._ids[index], index)
+            self._department_rows(self._departments[index]).add(self._ids[index], index)
+
+    def _compact(self):
+        """Drop deleted rows from the columns; runs on the refresh thread"""
+        # Taking rows in id order means the rebuilt indexes are plain appends
+        live = self._order.rows
+        self._ids = array("q", (self._ids[i] for i in live))
+        self._first_names = [self._first_names[i] for i in live]
+        self._last_names = [self._last_names[i] for i in live]
+        self._emails = [self._emails[i] for i in live]
+        self._phones = [self._phones[i] for i in live]
+        self._departments = array("i", (self._departments[i] for i in live))
+        self._positions = array("i", (self._positions[i] for i in live))
+        self._salaries = array("d", (self._salaries[i] for i in live))
+        self._hire_dates = array("i", (self._hire_dates[i] for i in live))
+        self._created_at = array("q", (self._created_at[i] for i in live))
+        self._updated_at = array("q", (self._updated_at[i] for i in live))
+        self._dead = 0
+        self._by_id = {employee_id: index for index, employee_id in enumerate(self._ids)}
+        self._by_email = {email: index for index, email in enumerate(self._emails)}
+        self._order = _SortedRows()
+        self._by_department = {}
+        for index, employee_id in enumerate(self._ids):
+            self._order.add(employee_id, index)
+            self._department_rows(self._departments[index]).add(employee_id, index)
+
+    def _to_dict(self, index):
+        salary = self._salaries[index]
+        hire_date = self._hire_dates[index]
+        updated_at = _decode_datetime(self._updated_at[index])
+        return {
+            "id": self._ids[index],
+            "first_name": self._first_names[index],
+            "last_name": self._last_names[index],
+            "email": self._emails[index],
+            "phone": self._phones[index],
+            "department": self._string(self._departments[index]),
+            "position": self._string(self._positions[index]),
+            "salary": None if math.isnan(salary) else salary,
+            "hire_date": str(date.fromordinal(hire_date)) if hire_date else None,
+            "created_at": str(_decode_datetime(self._created_at[index])),
+            "updated_at": str(updated_at) if updated_at else None
+        }
+
+    def get(self, employee_id):
+        with self._lock:
+            index = self._by_id.get(employee_id)
+            return None if index is None else self._to_dict(index)
+
+    def get_by_email(self, email):
+        with self._lock:
+            index = self._by_email.get(email)
+            return None if index is None else self._to_dict(index)
+
+    def page(self, skip=0, limit=100):
+        with self._lock:
+            return [self._to_dict(index) for index in self._order.page(skip, limit)]
+
+    def by_department(self, department, skip=0, limit=None):
+        with self._lock:
+            rows = self._by_department.get(self._codes.get(department))
+            if rows is None:
+                return []
+            return [self._to_dict(index) for index in rows.page(skip, limit)]
+
+    def apply(self, employee):
+        """Apply a write made through this process without waiting for a refresh"""
+        with self._lock:
+            self._apply_row(employee)
+
+    def remove(self, employee_id):
+        with self._lock:
+            self._remove(employee_id)
+
+    def load(self):
+        with self._lock:
+            self._clear()
+            self._watermark = None
+            # Rows from several shards arrive out of id order, so sort once at the end
+            for session_factory in employee_session_factories():
+                db = session_factory()
+                try:
+                    for row in db.query(*_COLUMNS).order_by(models.Employee.id).yield_per(5000):
+                        self._apply_row(row, update_indexes=False)
+                finally:
+                    db.close()
+            self._build_indexes()
+            self.loaded = True
+
+    def refresh(self):
+        """Pull rows changed since the last refresh and drop deleted ones"""
+        since = None if self._watermark is None else self._watermark - REFRESH_OVERLAP
+        count = 0
+        ids = set()
+        sessions = [session_factory() for session_factory in employee_session_factories()]
+        try:
+            for db in sessions:
+                query = db.query(*_COLUMNS)
+                if since is not None:
+                    query = query.filter(or_(
+                        models.Employee.created_at >= since,
+                        models.Employee.updated_at >= since
+                    ))
+                rows = query.order_by(models.Employee.id).all()
+                with self._lock:
+                    for row in rows:
+                        self._apply_row(row)
+                count += db.query(func.count(models.Employee.id)).scalar()
+
+            # Deletes leave no timestamp behind, and rows written with old timestamps
+            # fall outside the window, so reconcile ids when the counts differ
+            if count != len(self):
+                for db in sessions:
+                    ids.update(employee_id for (employee_id,) in db.query(models.Employee.id))
+                with self._lock:
+                    for employee_id in set(self._by_id) - ids:
+                        self._remove(employee_id)
+                    missing = sorted(ids - set(self._by_id))
+                for start in range(0, len(missing), _FETCH_BATCH):
+                    batch = missing[start:start + _FETCH_BATCH]
+                    for db in sessions:
+                        rows = db.query(*_COLUMNS).filter(models.Employee.id.in_(batch)).all()
+                        with self._lock:
+                            for row in rows:
+                                self._apply_row(row)
+
+            # Drop deleted rows once they make up half of the columns
+            with self._lock:
+                if self._dead and self._dead * 2 >= len(self._ids):
+                    self._compact()
+        finally:
+            for db in sessions:
+                db.close()
+
+    def start(self):
+        """Load the snapshot and keep refreshing it in a background thread"""
+        self.load()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._refresh_loop, name="snapshot-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _refresh_loop(self):
+        while not self._stop.wait(REFRESH_SECONDS):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Employee snapshot refresh failed")
+
+
+read_snapshot = EmployeeSnapshot() if SNAPSHOT_ENABLED else None
@@ -1,7 +1,18 @@
 from fastapi.testclient import TestClient
 from app.main import app
+from app import crud, jobs, main, models, schemas
+from app.database import SessionLocal, employee_session, employee_session_factories
+from app.snapshot import EmployeeSnapshot
+import asyncio
+import json
+import os
+import pytest
 import random
 import string
+import threading
+import time
+import uuid
+from datetime import datetime
 
 client = TestClient(app=app)
 
@@ -322,4 +333,356 @@ def test_duplicate_names_allowed():
             "salary": 80000
         }
     )
-    assert response2.status_code == 201  # Should succeed
\ No newline at end of file
+    assert response2.status_code == 201  # Should succeed
+
+def wait_for_job(job_id, timeout=30):
+    """Poll a background job until it stops running"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = client.get(f"/api/v1/jobs/{job_id}").json()["data"]
+        if job["status"] not in ("queued", "running", "cancelling"):
+            return job
+        time.sleep(0.1)
+    raise AssertionError(f"Job {job_id} did not finish in {timeout}s")
+
+def submit_import(rows):
+    """Upload rows as NDJSON to the import job endpoint"""
+    body = "\n".join(json.dumps(row) for row in rows)
+    return client.post(
+        "/api/v1/jobs/import", content=body, headers={"Content-Type": "application/x-ndjson"}
+    )
+
+def test_import_job():
+    """Test a background import with valid, invalid and duplicate rows"""
+    email = random_email()
+    rows = [
+        {"first_name": "Import", "last_name": "One", "email": email, "department": "Imports"},
+        {"first_name": "Import", "last_name": "Two", "email": random_email(), "salary": -5},
+        {"first_name": "Import", "last_name": "Three", "email": email},
+    ]
+    response = submit_import(rows)
+    assert response.status_code == 202
+    
+    job = wait_for_job(response.json()["data"]["id"])
+    assert job["status"] == "completed"
+    assert job["processed"] == 3
+    assert job["failed"] == 2
+    assert [err["row"] for err in job["errors"]] == [1, 2]
+    
+    result = client.get(f"/api/v1/jobs/{job['id']}/result")
+    assert result.json()["data"]["imported"] == 1
+
+def test_export_job():
+    """Test a background CSV export filtered by department"""
+    department = ''.join(random.choices(string.ascii_lowercase, k=8))
+    email = random_email()
+    client.post(
+        "/api/v1/employees",
+        json={
+            "first_name": "Export",
+            "last_name": "User",
+            "email": email,
+            "department": department
+        }
+    )
+    
+    response = client.post("/api/v1/jobs/export", json={"department": department})
+    assert response.status_code == 202
+    
+    job = wait_for_job(response.json()["data"]["id"])
+    assert job["status"] == "completed"
+    assert job["total"] == 1
+    
+    result = client.get(f"/api/v1/jobs/{job['id']}/result")
+    assert result.status_code == 200
+    lines = result.text.strip().splitlines()
+    assert len(lines) == 2
+    assert email in lines[1]
+
+def test_completed_job_cannot_be_resumed():
+    """Test that only cancelled or failed jobs can be resumed"""
+    response = client.post("/api/v1/jobs/export", json={})
+    job = wait_for_job(response.json()["data"]["id"])
+    
+    assert client.post(f"/api/v1/jobs/{job['id']}/resume").status_code == 409
+    assert client.post(f"/api/v1/jobs/{job['id']}/cancel").status_code == 409
+
+def test_get_nonexistent_job():
+    """Test getting a job that doesn't exist"""
+    response = client.get("/api/v1/jobs/doesnotexist")
+    assert response.status_code == 404
+
+def test_recover_only_fails_abandoned_jobs():
+    """Test that recovery fails jobs with an expired lease and leaves live workers' jobs alone"""
+    db = SessionLocal()
+    stale = models.Job(id=uuid.uuid4().hex, kind="export", status="running", owner="gone", heartbeat_at=datetime(2000, 1, 1))
+    live = models.Job(id=uuid.uuid4().hex, kind="export", status="running", owner="alive", heartbeat_at=jobs._now())
+    db.add_all([stale, live])
+    db.commit()
+    
+    jobs.manager.recover()
+    db.expire_all()
+    assert stale.status == "failed"
+    assert live.status == "running"
+    assert client.post(f"/api/v1/jobs/{stale.id}/resume").status_code == 200
+    assert wait_for_job(stale.id)["status"] == "completed"
+    
+    db.query(models.Job).filter(models.Job.id == live.id).update({"status": "cancelled"})
+    db.commit()
+    db.close()
+
+def staged_files():
+    return set(os.listdir(jobs.UPLOAD_DIR)) if os.path.isdir(jobs.UPLOAD_DIR) else set()
+
+def test_failed_upload_leaves_no_file(monkeypatch):
+    """Test that an interrupted or oversized upload does not leave a staging file behind"""
+    before = staged_files()
+    
+    async def disconnecting():
+        yield b'{"first_name": "Half"}\n'
+        raise ConnectionError("client went away")
+    with pytest.raises(ConnectionError):
+        asyncio.run(jobs.manager.stage_upload(disconnecting()))
+    
+    monkeypatch.setattr(jobs, "MAX_UPLOAD_BYTES", 10)
+    response = submit_import([{"first_name": "Too", "last_name": "Large", "email": random_email()}])
+    assert response.status_code == 413
+    assert staged_files() == before
+
+def test_stale_uploads_expire(monkeypatch):
+    """Test that uploads of imports left cancelled past the TTL are deleted and cannot be resumed"""
+    path = os.path.join(jobs.UPLOAD_DIR, f"{uuid.uuid4().hex}.ndjson")
+    os.makedirs(jobs.UPLOAD_DIR, exist_ok=True)
+    with open(path, "w") as f:
+        f.write("{}\n")
+    db = SessionLocal()
+    job = models.Job(
+        id=uuid.uuid4().hex, kind="import", status="cancelled", payload={"file": path},
+        total=1, processed=0, failed=0, heartbeat_at=datetime(2000, 1, 1)
+    )
+    db.add(job)
+    db.commit()
+    job_id = job.id
+    db.close()
+    
+    jobs.manager.expire_uploads()
+    assert not os.path.exists(path)
+    assert client.get(f"/api/v1/jobs/{job_id}").json()["data"]["status"] == "expired"
+    assert client.post(f"/api/v1/jobs/{job_id}/resume").status_code == 409
+
+def test_snapshot_matches_database():
+    """Test that snapshot reads return the same data as the database endpoints"""
+    department = ''.join(random.choices(string.ascii_lowercase, k=8))
+    created = client.post(
+        "/api/v1/employees",
+        json={
+            "first_name": "Snapshot",
+            "last_name": "User",
+            "email": random_email(),
+            "department": department,
+            "position": "Analyst",
+            "salary": 65000,
+            "hire_date": "2023-03-01"
+        }
+    ).json()["data"]
+    
+    snapshot = EmployeeSnapshot()
+    snapshot.load()
+    
+    assert snapshot.get(created["id"]) == client.get(f"/api/v1/employees/{created['id']}").json()["data"]
+    assert snapshot.get_by_email(created["email"])["id"] == created["id"]
+    assert snapshot.by_department(department) == client.get(f"/api/v1/employees/department/{department}").json()["data"]
+    assert snapshot.page(skip=1, limit=5) == client.get("/api/v1/employees?skip=1&limit=5").json()["data"]
+    assert snapshot.get(99999) is None
+
+def test_snapshot_refresh_and_writes():
+    """Test that the snapshot picks up new rows and applies updates and deletes"""
+    snapshot = EmployeeSnapshot()
+    snapshot.load()
+    
+    department = ''.join(random.choices(string.ascii_lowercase, k=8))
+    employee_id = client.post(
+        "/api/v1/employees",
+        json={
+            "first_name": "Refresh",
+            "last_name": "User",
+            "email": random_email(),
+            "department": department
+        }
+    ).json()["data"]["id"]
+    assert snapshot.get(employee_id) is None
+    
+    snapshot.refresh()
+    assert snapshot.get(employee_id)["department"] == department
+    
+    client.put(f"/api/v1/employees/{employee_id}", json={"department": "Moved"})
+    snapshot.refresh()
+    assert snapshot.by_department(department) == []
+    assert snapshot.get(employee_id)["department"] == "Moved"
+    
+    client.delete(f"/api/v1/employees/{employee_id}")
+    snapshot.refresh()
+    assert snapshot.get(employee_id) is None
+
+def test_snapshot_refresh_finds_backdated_rows():
+    """Test that refresh picks up rows whose timestamps are older than its window"""
+    # A recent row so the snapshot has a watermark to refresh from
+    client.post("/api/v1/employees", json={"first_name": "Recent", "last_name": "User", "email": random_email()})
+    snapshot = EmployeeSnapshot()
+    snapshot.load()
+    snapshot.refresh()
+    
+    employee_id = client.post(
+        "/api/v1/employees",
+        json={"first_name": "Backfill", "last_name": "User", "email": random_email()}
+    ).json()["data"]["id"]
+    # Like a backfill that keeps the original timestamps
+    for session_factory in employee_session_factories():
+        db = session_factory()
+        db.query(models.Employee).filter(models.Employee.id == employee_id).update(
+            {"created_at": datetime(2020, 1, 1), "updated_at": datetime(2020, 1, 1)}, synchronize_session=False
+        )
+        db.commit()
+        db.close()
+    
+    snapshot.refresh()
+    assert snapshot.get(employee_id)["first_name"] == "Backfill"
+    assert snapshot.get(employee_id)["created_at"] == "2020-01-01 00:00:00"
+
+def block_call(monkeypatch, module, name, call_number):
+    """Make module.name wait on its nth call until the returned release event is set"""
+    original = getattr(module, name)
+    reached = threading.Event()
+    release = threading.Event()
+    calls = []
+    
+    def wrapper(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == call_number:
+            reached.set()
+            release.wait(10)
+        return original(*args, **kwargs)
+    
+    monkeypatch.setattr(module, name, wrapper)
+    return reached, release
+
+def test_import_job_cancel_and_resume(monkeypatch):
+    """Test that a cancelled import resumes from its checkpoint without re-importing rows"""
+    monkeypatch.setattr(jobs, "CHUNK_SIZE", 5)
+    monkeypatch.setattr(jobs, "PROCESS_WORKERS", 0)
+    reached, release = block_call(monkeypatch, crud, "create_employees_bulk", 2)
+    
+    keyword = ''.join(random.choices(string.ascii_lowercase, k=10))
+    rows = [{"first_name": keyword, "last_name": "Resume", "email": random_email()} for _ in range(23)]
+    job_id = submit_import(rows).json()["data"]["id"]
+    
+    assert reached.wait(10)
+    assert client.post(f"/api/v1/jobs/{job_id}/cancel").json()["data"]["status"] == "cancelling"
+    release.set()
+    
+    # The chunk in flight when the cancel arrived is still recorded
+    job = wait_for_job(job_id)
+    assert job["status"] == "cancelled"
+    assert job["processed"] == 10
+    assert job["result"]["imported"] == 10
+    
+    assert client.post(f"/api/v1/jobs/{job_id}/resume").status_code == 200
+    job = wait_for_job(job_id)
+    assert job["status"] == "completed"
+    assert job["processed"] == 23
+    assert job["failed"] == 0
+    assert job["result"]["imported"] == 23
+    
+    found = client.get(f"/api/v1/employees/search/query?keyword={keyword}").json()["data"]
+    assert sorted(emp["email"] for emp in found) == sorted(row["email"] for row in rows)
+
+def test_export_job_cancel_and_resume(monkeypatch):
+    """Test that a resumed export writes every row exactly once"""
+    monkeypatch.setattr(jobs, "CHUNK_SIZE", 5)
+    department = ''.join(random.choices(string.ascii_lowercase, k=8))
+    for _ in range(12):
+        client.post(
+            "/api/v1/employees",
+            json={"first_name": "Export", "last_name": "Resume", "email": random_email(), "department": department}
+        )
+    reached, release = block_call(monkeypatch, crud, "get_employee_rows", 2)
+    
+    job_id = client.post("/api/v1/jobs/export", json={"department": department}).json()["data"]["id"]
+    assert reached.wait(10)
+    client.post(f"/api/v1/jobs/{job_id}/cancel")
+    release.set()
+    
+    job = wait_for_job(job_id)
+    assert job["status"] == "cancelled"
+    assert job["processed"] == 10
+    
+    client.post(f"/api/v1/jobs/{job_id}/resume")
+    job = wait_for_job(job_id)
+    assert job["status"] == "completed"
+    
+    lines = client.get(f"/api/v1/jobs/{job_id}/result").text.strip().splitlines()
+    ids = [line.split(",")[0] for line in lines[1:]]
+    assert len(ids) == 12
+    assert len(set(ids)) == 12
+
+def test_job_queue_limit(monkeypatch):
+    """Test that new jobs are rejected with 429 once the queue is full"""
+    monkeypatch.setattr(jobs, "MAX_QUEUED_JOBS", 1)
+    monkeypatch.setattr(jobs, "PROCESS_WORKERS", 0)
+    reached, release = block_call(monkeypatch, crud, "create_employees_bulk", 1)
+    
+    response = submit_import([{"first_name": "Queue", "last_name": "Limit", "email": random_email()}])
+    assert response.status_code == 202
+    assert reached.wait(10)
+    
+    assert submit_import([{"first_name": "Queue", "last_name": "Full", "email": random_email()}]).status_code == 429
+    assert client.post("/api/v1/jobs/export", json={}).status_code == 429
+    
+    release.set()
+    assert wait_for_job(response.json()["data"]["id"])["status"] == "completed"
+
+def test_run_releases_only_its_own_slot():
+    """Test that an old run of a job finishing late does not free the slot of its resumed run"""
+    before = len(jobs.manager._active)
+    old_run = jobs.manager._reserve("resumed-job")
+    new_run = jobs.manager._reserve("resumed-job")
+    jobs.manager._release(old_run)
+    assert len(jobs.manager._active) == before + 1
+    jobs.manager._release(new_run)
+    assert len(jobs.manager._active) == before
+
+def test_endpoints_served_from_snapshot(monkeypatch):
+    """Test the GET endpoints with a loaded snapshot, and that PUT and DELETE keep it current"""
+    department = ''.join(random.choices(string.ascii_lowercase, k=8))
+    employee_id = client.post(
+        "/api/v1/employees",
+        json={"first_name": "Served", "last_name": "Snapshot", "email": random_email(), "department": department}
+    ).json()["data"]["id"]
+    
+    snapshot = EmployeeSnapshot()
+    snapshot.load()
+    monkeypatch.setattr(main, "read_snapshot", snapshot)
+    
+    # A row written straight to the DB is not visible until the next refresh
+    db = employee_session()
+    hidden_id = crud.create_employee(
+        db, schemas.EmployeeCreate(first_name="Hidden", last_name="Row", email=random_email(), department=department)
+    ).id
+    db.close()
+    assert client.get(f"/api/v1/employees/{hidden_id}").status_code == 404
+    
+    response = client.get(f"/api/v1/employees/{employee_id}")
+    assert response.status_code == 200
+    assert response.json()["data"]["first_name"] == "Served"
+    assert [emp["id"] for emp in client.get(f"/api/v1/employees/department/{department}").json()["data"]] == [employee_id]
+    assert client.get("/api/v1/employees?skip=0&limit=1000").json()["data"] == snapshot.page(0, 1000)
+    
+    # PUT applies the change to the snapshot
+    client.put(f"/api/v1/employees/{employee_id}", json={"department": "Relocated"})
+    assert client.get(f"/api/v1/employees/department/{department}").json()["data"] == []
+    assert client.get(f"/api/v1/employees/{employee_id}").json()["data"]["department"] == "Relocated"
+    
+    # DELETE removes the row from the snapshot
+    client.delete(f"/api/v1/employees/{employee_id}")
+    assert client.get(f"/api/v1/employees/{employee_id}").status_code == 404
+    assert employee_id not in [emp["id"] for emp in client.get("/api/v1/employees?limit=1000").json()["data"]]
@@ -0,0 +1,197 @@
+import pytest
+import threading
+import time
+from datetime import datetime
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app import crud, models, schemas, sharding
+from app.database import ShardedSession
+
+SHARD_COUNT = 3
+
+@pytest.fixture
+def factories(tmp_path):
+    """Session factories for three SQLite shard files"""
+    factories = []
+    for index in range(SHARD_COUNT):
+        engine = create_engine(f"sqlite:///{tmp_path / f'shard{index}.db'}")
+        sharding.init_shard(engine)
+        factories.append(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    return factories
+
+@pytest.fixture
+def db(factories):
+    """A sharded session over three SQLite files"""
+    session = ShardedSession(factories)
+    yield session
+    session.close()
+
+def make_employee(number, department="Engineering"):
+    return schemas.EmployeeCreate(
+        first_name="Shard",
+        last_name="User",
+        email=f"user{number}@example.com",
+        department=department,
+        position="Developer"
+    )
+
+def test_employees_route_to_their_shard(db):
+    """Test that new employees get unique ids that route back to their shard"""
+    employees = [crud.create_employee(db, make_employee(number)) for number in range(12)]
+
+    ids = [employee.id for employee in employees]
+    assert len(set(ids)) == len(ids)
+    for employee in employees:
+        shard = sharding.shard_for_id(employee.id, SHARD_COUNT)
+        assert shard == sharding.shard_for_email(employee.email, SHARD_COUNT)
+        assert db.shard(shard).get(models.Employee, employee.id) is not None
+        assert crud.get_employee(db, employee.id).email == employee.email
+
+def test_fan_out_ordering_and_pagination(db):
+    """Test that list, search and department queries merge shards in id order"""
+    for number in range(15):
+        crud.create_employee(db, make_employee(number, department="Sales" if number % 2 else "Support"))
+    all_ids = sorted(employee.id for employee in crud.get_employees(db, limit=100))
+
+    assert len(all_ids) == 15
+    assert [e.id for e in crud.get_employees(db, skip=4, limit=5)] == all_ids[4:9]
+
+    sales = crud.get_by_department(db, "Sales")
+    assert [e.id for e in sales] == sorted(e.id for e in sales)
+    assert len(sales) == 7
+    assert [e.id for e in crud.get_by_department(db, "Sales", skip=2, limit=3)] == [e.id for e in sales[2:5]]
+
+    assert [e.id for e in crud.search_employees(db, "user1")] == sorted(
+        e.id for e in crud.get_employees(db, limit=100) if e.email.startswith("user1")
+    )
+    assert crud.count_employees(db) == 15
+    assert crud.count_employees(db, department="Support") == 8
+
+def test_email_uniqueness_across_shards(db):
+    """Test that emails stay unique when they move between shards"""
+    first = crud.create_employee(db, make_employee(1))
+    second = crud.create_employee(db, make_employee(2))
+
+    with pytest.raises(HTTPException) as error:
+        crud.create_employee(db, make_employee(1))
+    assert error.value.status_code == 400
+
+    with pytest.raises(HTTPException) as error:
+        crud.update_employee(db, second.id, schemas.EmployeeUpdate(email=first.email))
+    assert error.value.status_code == 400
+
+    crud.update_employee(db, first.id, schemas.EmployeeUpdate(email="moved@example.com"))
+    assert crud.get_employee(db, first.id).email == "moved@example.com"
+    # The old email is free again, and the new one is taken
+    crud.create_employee(db, make_employee(1))
+    with pytest.raises(HTTPException):
+        crud.create_employee(db, schemas.EmployeeCreate(first_name="Other", last_name="User", email="moved@example.com"))
+
+    crud.delete_employee(db, second.id)
+    with pytest.raises(HTTPException) as error:
+        crud.get_employee(db, second.id)
+    assert error.value.status_code == 404
+    crud.create_employee(db, make_employee(2))
+
+def test_bulk_create_across_shards(db):
+    """Test that bulk inserts spread rows over shards and reject taken emails"""
+    crud.create_employee(db, make_employee(0))
+    rows = [(number, make_employee(number).model_dump()) for number in range(10)]
+    rows.append((10, make_employee(5).model_dump()))
+
+    created, errors = crud.create_employees_bulk(db, rows)
+    db.commit()
+
+    assert created == 9
+    assert sorted(error["row"] for error in errors) == [0, 10]
+    assert crud.count_employees(db) == 10
+    assert len({sharding.shard_for_id(e.id, SHARD_COUNT) for e in crud.get_employees(db)}) > 1
+    # Each shard reserves ids in blocks from a single counter row
+    for session in db.all():
+        assert session.query(models.EmployeeIdSequence).count() == 1
+
+def test_overlapping_bulk_creates(factories, monkeypatch):
+    """Test that two bulk inserts touching shards in opposite order both finish"""
+    allocate_ids = sharding.allocate_ids
+    def slow_allocate_ids(*args):
+        # Hold the counter lock long enough for the other insert to reach its next shard
+        ids = allocate_ids(*args)
+        time.sleep(0.2)
+        return ids
+    monkeypatch.setattr(sharding, "allocate_ids", slow_allocate_ids)
+
+    by_shard = {}
+    for number in range(60):
+        by_shard.setdefault(sharding.shard_for_email(make_employee(number).email, SHARD_COUNT), []).append(number)
+    first, last = min(by_shard), max(by_shard)
+    # Different emails on the same two shards, listed in opposite shard order
+    batches = [
+        by_shard[first][:5] + by_shard[last][:5],
+        by_shard[last][5:10] + by_shard[first][5:10],
+    ]
+
+    results = []
+    def run(batch):
+        session = ShardedSession(factories)
+        try:
+            rows = [(number, make_employee(number).model_dump()) for number in batch]
+            results.append(crud.create_employees_bulk(session, rows))
+            session.commit()
+        except Exception as e:
+            results.append(e)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=run, args=(batch,)) for batch in batches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not [result for result in results if isinstance(result, Exception)]
+    assert sorted(created for created, _ in results) == sorted(len(batch) for batch in batches)
+    check = ShardedSession(factories)
+    assert crud.count_employees(check) == sum(len(batch) for batch in batches)
+    check.close()
+
+def test_fan_out_waits_for_every_shard(db):
+    """Test that a failing shard does not return before the other shards finish"""
+    finished = []
+    def query(session):
+        if session is db.shard(0):
+            raise RuntimeError("shard down")
+        time.sleep(0.2)
+        finished.append(session)
+
+    with pytest.raises(RuntimeError):
+        sharding.fan_out(db, query)
+    assert len(finished) == SHARD_COUNT - 1
+
+def test_stale_email_claim_is_taken_over(db):
+    """Test that a directory entry left by a lost release does not reserve the email for good"""
+    employee = crud.create_employee(db, make_employee(1))
+    crud.update_employee(db, employee.id, schemas.EmployeeUpdate(email="renamed@example.com"))
+
+    # Simulate a release that never ran: the old email still points at the employee
+    shard = db.shard(sharding.shard_for_email("user1@example.com", SHARD_COUNT))
+    shard.add(models.EmployeeEmail(email="user1@example.com", employee_id=employee.id))
+    shard.commit()
+    with pytest.raises(HTTPException):
+        crud.create_employee(db, make_employee(1))
+
+    # Once older than the grace period, the stale entry is taken over
+    shard.query(models.EmployeeEmail).filter(models.EmployeeEmail.email == "user1@example.com").update(
+        {models.EmployeeEmail.claimed_at: datetime(2000, 1, 1)}
+    )
+    shard.commit()
+    taken_over = crud.create_employee(db, make_employee(1))
+    assert crud.get_employee(db, taken_over.id).email == "user1@example.com"
+
+    # A live claim is never taken over, however old it is
+    shard.query(models.EmployeeEmail).filter(models.EmployeeEmail.email == "user1@example.com").update(
+        {models.EmployeeEmail.claimed_at: datetime(2000, 1, 1)}
+    )
+    shard.commit()
+    with pytest.raises(HTTPException):
+        crud.create_employee(db, make_employee(1))